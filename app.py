@@ -1,20 +1,69 @@
 import os
-from flask import Flask, render_template, request, redirect, url_for, flash, current_app
+import hashlib
+import secrets
+import sqlite3
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+import click
+import qrcode
+from flask import Flask, render_template, request, redirect, url_for, flash, current_app, make_response
 from flask_sqlalchemy import SQLAlchemy
+from flask_caching import Cache
+from sqlalchemy import event, text
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import joinedload, raiseload, selectinload
 from flask_wtf import FlaskForm
-from wtforms import SelectField, StringField, PasswordField, SubmitField
-from wtforms.validators import DataRequired, Length, EqualTo
-from flask_wtf.file import FileField
-from werkzeug.utils import secure_filename
-from werkzeug.security import generate_password_hash, check_password_hash
+from wtforms import IntegerField, SelectField, StringField, PasswordField, SubmitField
+from wtforms.validators import DataRequired, InputRequired, Length, EqualTo, NumberRange
+from flask_wtf.file import FileAllowed, FileField
+from argon2 import PasswordHasher
+from argon2.exceptions import VerifyMismatchError, InvalidHashError
+from werkzeug.security import check_password_hash
 from flask_login import LoginManager, login_user, login_required, current_user, UserMixin
 
 # Initialize Flask app
 app = Flask(__name__)
 app.config['SECRET_KEY'] = 'mysecret'
 app.config['UPLOAD_FOLDER'] = 'static/uploads'  # Folder where images will be saved
+app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # Reject uploads larger than 16 MB
+app.config['UPLOAD_MAX_AGE'] = 31536000  # Uploaded files never change once written, cache for a year
+app.config['PRODUCT_PAGE_MAX_AGE'] = 3600
 app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///rice_shop.db'  # SQLite database for simplicity
+app.config['WTF_CSRF_TIME_LIMIT'] = None  # CSRF tokens last for the session instead of expiring hourly
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {'pool_size': 10}
+# In development, relationships not eager-loaded by a list query raise instead of querying per row
+app.config['STRICT_LOADING'] = os.environ.get('FLASK_DEBUG') == '1'
+app.config['PRODUCTS_PER_PAGE'] = 24  # Page size for product listings
+app.config['CACHE_TYPE'] = 'SimpleCache'  # In-process cache for rendered pages
+app.config['CACHE_DEFAULT_TIMEOUT'] = 60
 db = SQLAlchemy(app)
+cache = Cache(app)
+
+# Tune every new SQLite connection: WAL lets readers run alongside a writer
+@event.listens_for(Engine, 'connect')
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    if not isinstance(dbapi_connection, sqlite3.Connection):
+        return
+    cursor = dbapi_connection.cursor()
+    cursor.execute('PRAGMA journal_mode=WAL')
+    cursor.execute('PRAGMA synchronous=NORMAL')
+    cursor.execute('PRAGMA temp_store=MEMORY')
+    cursor.execute('PRAGMA mmap_size=134217728')  # 128 MB
+    cursor.close()
+
+IO_POOL = ThreadPoolExecutor(max_workers=4)  # Background workers for saving uploaded files
+
+# argon2 cost per hash, read from the environment once at startup;
+# lower these on slow hardware to bound login/register latency
+ARGON2_TIME_COST = int(os.environ.get('ARGON2_TIME_COST', 2))
+ARGON2_MEMORY_COST = int(os.environ.get('ARGON2_MEMORY_COST', 64 * 1024))  # KiB
+
+# Password hashing with a fixed, tunable cost so login latency stays predictable
+ph = PasswordHasher(time_cost=ARGON2_TIME_COST, memory_cost=ARGON2_MEMORY_COST, parallelism=1)
+
+# Stand-in hash verified against when a login username doesn't exist
+DUMMY_HASH = ph.hash(secrets.token_hex(16))
 
 # Initialize Flask-Login
 login_manager = LoginManager()
@@ -24,65 +73,150 @@ login_manager.login_view = 'login'  # Define the login route for redirects
 # Define database models
 class Farmer(UserMixin, db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    username = db.Column(db.String(150), unique=True, nullable=False)
-    password = db.Column(db.String(150), nullable=False)
+    username = db.Column(db.String(150), unique=True, nullable=False, index=True)
+    password = db.Column(db.String(255), nullable=False)  # Wide enough for argon2 hashes
     role = db.Column(db.String(50), nullable=False)
-    rice_products = db.relationship('RiceProduct', backref='farmer', lazy=True)
+    # lazy='raise' catches accidental per-row loads; query products explicitly instead
+    rice_products = db.relationship('RiceProduct', back_populates='farmer', lazy='raise')
     qr_code = db.Column(db.String(100), nullable=True) 
 
+    def set_password(self, password):
+        self.password = ph.hash(password)
+
+    def check_password(self, password):
+        return verify_password(self.password, password)
+
 class RiceProduct(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(100), nullable=False)
     description = db.Column(db.String(500))
-    price = db.Column(db.Float, nullable=False)
+    price = db.Column(db.Integer, nullable=False)  # Stored in cents to avoid float rounding
     quantity = db.Column(db.Integer, nullable=False)
     image = db.Column(db.String(100), nullable=True)  # Add image column to store filename
-    farmer_id = db.Column(db.Integer, db.ForeignKey('farmer.id'), nullable=False)
+    farmer_id = db.Column(db.Integer, db.ForeignKey('farmer.id'), nullable=False, index=True)
+    farmer = db.relationship('Farmer', back_populates='rice_products')
 
 # Forms for handling user input
+# Validators are stateless, so share one set of instances across all forms
+_REQUIRED = (DataRequired(),)
+# InputRequired, unlike DataRequired, keeps IntegerField's "Not a valid integer value" error
+_POSITIVE = (InputRequired(), NumberRange(min=1))
+
+ALLOWED_IMAGE_EXTENSIONS = ('jpg', 'jpeg', 'png', 'gif', 'webp')
+
 class LoginForm(FlaskForm):
-    username = StringField('Username', validators=[DataRequired()])
-    password = PasswordField('Password', validators=[DataRequired()])
+    username = StringField('Username', validators=_REQUIRED)
+    password = PasswordField('Password', validators=_REQUIRED)
     submit = SubmitField('Login')
 
 class RegisterForm(FlaskForm):
-    username = StringField('Username', validators=[DataRequired()])
-    password = PasswordField('Password', validators=[DataRequired()])
-    confirm_password = PasswordField('Confirm Password', validators=[DataRequired(), EqualTo('password')])
-    role = SelectField('Role', choices=[('farmer', 'Farmer'), ('buyer', 'Buyer')], validators=[DataRequired()])
+    username = StringField('Username', validators=_REQUIRED)
+    password = PasswordField('Password', validators=_REQUIRED)
+    confirm_password = PasswordField('Confirm Password', validators=_REQUIRED + (EqualTo('password'),))
+    role = SelectField('Role', choices=[('farmer', 'Farmer'), ('buyer', 'Buyer')], validators=_REQUIRED)
     submit = SubmitField('Register')
 
 class SellRiceForm(FlaskForm):
-    name = StringField('Rice Name', validators=[DataRequired()])
+    name = StringField('Rice Name', validators=_REQUIRED)
     description = StringField('Description')
-    price = StringField('Price', validators=[DataRequired()])
-    quantity = StringField('Quantity', validators=[DataRequired()])
-    image = FileField('Upload Rice Image')  # Add file upload field
+    price = IntegerField('Price (cents)', validators=_POSITIVE)
+    quantity = IntegerField('Quantity', validators=_POSITIVE)
+    image = FileField('Upload Rice Image', validators=[FileAllowed(ALLOWED_IMAGE_EXTENSIONS, 'Images only!')])
     submit = SubmitField('Sell Rice')
 
-class User(UserMixin, db.Model):
-    id = db.Column(db.Integer, primary_key=True)
-    username = db.Column(db.String(150), unique=True, nullable=False)
-    email = db.Column(db.String(150), unique=True, nullable=False)
-    password = db.Column(db.String(150), nullable=False)
-
-    def set_password(self, password):
-        self.password = generate_password_hash(password)
-
-    def check_password(self, password):
-        return check_password_hash(self.password, password)
+def verify_password(stored_hash, password):
+    if not stored_hash.startswith('$argon2'):
+        # Accounts created before the switch to argon2 still have werkzeug hashes
+        try:
+            return check_password_hash(stored_hash, password)
+        except ValueError:  # Malformed or unsupported stored value
+            return False
+    try:
+        return ph.verify(stored_hash, password)
+    except (VerifyMismatchError, InvalidHashError):
+        return False
+
+def needs_rehash(stored_hash):
+    return not stored_hash.startswith('$argon2') or ph.check_needs_rehash(stored_hash)
+
+@app.after_request
+def set_cache_headers(response):
+    if (request.endpoint == 'static' and response.status_code in (200, 304)
+            and request.view_args.get('filename', '').startswith('uploads/')):
+        response.cache_control.no_cache = None  # Flask marks static files no-cache by default
+        response.cache_control.public = True
+        response.cache_control.max_age = app.config['UPLOAD_MAX_AGE']
+    elif request.endpoint == 'product_details' and response.status_code in (200, 304):
+        # Pages for logged-in users show role-specific links, so keep them out of shared caches
+        if current_user.is_authenticated:
+            response.cache_control.private = True
+        else:
+            response.cache_control.public = True
+        response.cache_control.max_age = app.config['PRODUCT_PAGE_MAX_AGE']
+        response.vary.add('Cookie')
+        response.make_conditional(request)  # Turns cached 200s into 304s when the ETag matches
+    return response
+
+def upload_filename(blob, original_filename):
+    # Name uploads by content hash so re-uploads of the same image share one file
+    digest = hashlib.blake2b(blob, digest_size=16).hexdigest()
+    # Take the extension from the raw name: secure_filename drops non-ASCII stems
+    # (e.g. '图片.png' becomes 'png'), which would lose the extension
+    ext = os.path.splitext(original_filename)[1].lower()
+    if ext.lstrip('.') not in ALLOWED_IMAGE_EXTENSIONS:
+        ext = ''
+    return f"{digest}{ext}"
+
+def _write_file(filepath, blob):
+    # Write to a temp file in the same folder, then rename, so the final name
+    # only ever points at a complete file
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(filepath), prefix='.upload-')
+    try:
+        with os.fdopen(fd, 'wb') as dst:
+            dst.write(blob)
+        os.chmod(tmp_path, 0o644)  # mkstemp creates owner-only files
+        os.replace(tmp_path, filepath)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+def _log_write_error(future):
+    exc = future.exception()
+    if exc is not None:
+        app.logger.error('Failed to save uploaded file', exc_info=exc)
+
+@app.template_filter('cents')
+def format_cents(cents):
+    return f"{cents / 100:.2f}"
 
 # Flask-Login requires a user loader to load the user from the database
 @login_manager.user_loader
 def load_user(user_id):
-    return Farmer.query.get(int(user_id))
+    # Flask-Login already calls this at most once per request and keeps the result on g
+    return db.session.get(Farmer, int(user_id))
+
+
+def strict_loading_options():
+    return (raiseload('*'),) if app.config['STRICT_LOADING'] else ()
+
+def is_logged_in():
+    # Pages render role-specific links, so only anonymous visitors share cached copies
+    return current_user.is_authenticated
 
 
 # Routes for pages
 @app.route('/')
+@cache.cached(timeout=30, query_string=True, unless=is_logged_in)
 def index():
-    products = RiceProduct.query.all()
-    return render_template('index.html', products=products)
+    page = request.args.get('page', 1, type=int)
+    # Load every product's seller in one extra query instead of one per product,
+    # fetching only the username the product card shows (never the password hash)
+    pagination = (RiceProduct.query
+                  .options(selectinload(RiceProduct.farmer).load_only(Farmer.username),
+                           *strict_loading_options())
+                  .order_by(RiceProduct.id.desc())
+                  .paginate(page=page, per_page=app.config['PRODUCTS_PER_PAGE'], error_out=False))
+    return render_template('index.html', products=pagination.items, pagination=pagination)
 
 
 @app.route('/login', methods=['GET', 'POST'])
@@ -90,7 +224,17 @@ def login():
     form = LoginForm()
     if form.validate_on_submit():
         farmer = Farmer.query.filter_by(username=form.username.data).first()
-        if farmer and check_password_hash(farmer.password, form.password.data):  # Note: use proper password hashing
+        if farmer:
+            password_ok = farmer.check_password(form.password.data)
+        else:
+            # Still run one hash verification so timing doesn't reveal whether the username exists
+            verify_password(DUMMY_HASH, form.password.data)
+            password_ok = False
+        if password_ok:
+            # Upgrade legacy hashes, or argon2 hashes whose cost parameters have changed
+            if needs_rehash(farmer.password):
+                farmer.password = ph.hash(form.password.data)
+                db.session.commit()
             login_user(farmer)  # Log the user in
             flash('Logged in successfully!')
             return redirect(url_for('index'))
@@ -118,21 +262,24 @@ def login():
 def register():
     form = RegisterForm()
     if form.validate_on_submit():
-        # Check if username is already taken
-        user_exists = Farmer.query.filter_by(username=form.username.data).first()
-        if user_exists:
-            flash('Username already exists. Please choose another.', 'error')
-            return redirect(url_for('register'))
-        
         # Create a new farmer user
-        hashed_password = generate_password_hash(form.password.data)  # Hash password before saving
         farmer = Farmer(
             username=form.username.data, 
-            password=hashed_password, 
             role=form.role.data  # Save the selected role
         )
+        farmer.set_password(form.password.data)  # Hash password before saving
         db.session.add(farmer)
-        db.session.commit()
+        try:
+            db.session.commit()
+        except IntegrityError:
+            # The unique constraint on username rejects duplicates, so no lookup is needed first
+            db.session.rollback()
+            flash('Username already exists. Please choose another.', 'error')
+            return redirect(url_for('register'))
+        if farmer.role == 'farmer':
+            # Generate the payment QR code once here instead of on every checkout
+            farmer.qr_code = generate_qr_code(farmer.id)
+            db.session.commit()
         flash('Registered successfully!')
         return redirect(url_for('login'))  # Redirect to login page
     return render_template('register.html', form=form)
@@ -149,9 +296,14 @@ def sell_rice():
     if form.validate_on_submit():
         # Handle image upload
         if form.image.data:
-            filename = secure_filename(form.image.data.filename)
+            blob = form.image.data.read()  # Bounded by MAX_CONTENT_LENGTH
+            filename = upload_filename(blob, form.image.data.filename)
             filepath = os.path.join(current_app.config['UPLOAD_FOLDER'], filename)
-            form.image.data.save(filepath)
+            # Identical images are stored only once. _write_file renames complete files
+            # into place, so an existing name never refers to a partial write.
+            if not os.path.exists(filepath):
+                future = IO_POOL.submit(_write_file, filepath, blob)  # Save while the product row is committed
+                future.add_done_callback(_log_write_error)
         else:
             filename = None
         
@@ -165,15 +317,36 @@ def sell_rice():
         )
         db.session.add(rice)
         db.session.commit()
+        cache.clear()  # Drop cached listings so the new product shows up right away
         flash('Rice product added!')
         return redirect(url_for('index'))
     return render_template('sell_rice.html', form=form)
 
 
+def product_etag(product):
+    # Covers every product field product_details.html renders, plus the viewer's role
+    role = current_user.role if current_user.is_authenticated else 'anonymous'
+    fields = (product.id, product.name, product.description, product.price,
+              product.quantity, product.image, role)
+    key = '\0'.join(str(field) for field in fields)
+    return hashlib.md5(key.encode(), usedforsecurity=False).hexdigest()
+
+def is_ok(response):
+    return response.status_code == 200
+
+
 @app.route('/product/<int:id>')
+@cache.cached(timeout=300, unless=is_logged_in, response_filter=is_ok)
 def product_details(id):
-    product = RiceProduct.query.get_or_404(id)
-    return render_template('product_details.html', product=product)
+    product = db.get_or_404(RiceProduct, id)
+    etag = product_etag(product)
+    if request.if_none_match.contains(etag):
+        # The browser already has this page, skip rendering the template
+        response = current_app.response_class(status=304)
+    else:
+        response = make_response(render_template('product_details.html', product=product))
+    response.set_etag(etag)
+    return response
 
 # @app.route('/profile')
 # @login_required
@@ -192,8 +365,13 @@ def profile():
     if current_user.role != 'farmer':
         flash('You must be a farmer to view this page.')
         return redirect(url_for('index'))
-    products = RiceProduct.query.filter_by(farmer_id=current_user.id).all()
-    return render_template('profile.html', products=products)
+    page = request.args.get('page', 1, type=int)
+    pagination = (RiceProduct.query
+                  .options(*strict_loading_options())
+                  .filter_by(farmer_id=current_user.id)
+                  .order_by(RiceProduct.id.desc())
+                  .paginate(page=page, per_page=app.config['PRODUCTS_PER_PAGE'], error_out=False))
+    return render_template('profile.html', products=pagination.items, pagination=pagination)
 
 
 
@@ -214,28 +392,62 @@ def buy_now(id):
         flash('Only buyers can make purchases.')
         return redirect(url_for('index'))
 
-    # Get the product from the database
-    product = RiceProduct.query.get_or_404(id)
-
-    # Get the farmer who is selling this product
-    farmer = Farmer.query.get_or_404(product.farmer_id)
+    # Get the product and the farmer selling it in a single joined query
+    product = (RiceProduct.query
+               .options(joinedload(RiceProduct.farmer))
+               .filter_by(id=id)
+               .first_or_404())
+    farmer = product.farmer
 
-    # Fetch the farmer's QR code (assume the QR code filename is stored in the Farmer table)
-    farmer_qr_code = farmer.qr_code  # Assuming this field is present in the Farmer model
+    # QR codes are generated at registration; backfill farmers registered before that
+    if farmer.qr_code is None:
+        farmer.qr_code = generate_qr_code(farmer.id)
+        db.session.commit()
+    farmer_qr_code = farmer.qr_code
 
     # Render the payment page, passing the product and farmer's QR code
     return render_template('payment_page.html', product=product, farmer_qr_code=farmer_qr_code)
 
-def generate_qr_code(farmer_id):
-    qr = qrcode.make(f"payment_info_for_farmer_{farmer_id}")  # Some unique information for the farmer
+def get_qr_path(farmer_id):
     qr_filename = f"farmer_{farmer_id}_qr.png"
-    qr_path = os.path.join(current_app.config['UPLOAD_FOLDER'], qr_filename)
-    qr.save(qr_path)
+    return qr_filename, os.path.join(current_app.config['UPLOAD_FOLDER'], qr_filename)
+
+def generate_qr_code(farmer_id):
+    qr_filename, qr_path = get_qr_path(farmer_id)
+    if not os.path.exists(qr_path):  # QR content never changes, so reuse an existing image
+        qr = qrcode.make(f"payment_info_for_farmer_{farmer_id}")  # Some unique information for the farmer
+        qr.save(qr_path)
     return qr_filename
 
+def migrate_prices_to_cents():
+    # One-off migration: databases whose price column is still FLOAT store whole
+    # currency units, convert them to cents. user_version records that it has run.
+    if db.session.execute(text('PRAGMA user_version')).scalar() >= 1:
+        return
+    price_type = db.session.execute(
+        text("SELECT type FROM pragma_table_info('rice_product') WHERE name = 'price'")).scalar()
+    if price_type is None:
+        return  # Tables not created yet; init-db creates them with the Integer column
+    if price_type == 'FLOAT':
+        db.session.execute(text('UPDATE rice_product SET price = CAST(ROUND(price * 100) AS INTEGER)'))
+    db.session.execute(text('PRAGMA user_version = 1'))
+    db.session.commit()
+
+# One-time database setup: run `flask --app app init-db`
+@app.cli.command('init-db')
+def init_db():
+    db.create_all()  # This will create the database tables
+    # create_all() doesn't add indexes to tables that already exist
+    db.session.execute(text('CREATE INDEX IF NOT EXISTS ix_rice_product_farmer_id ON rice_product (farmer_id)'))
+    db.session.commit()
+    migrate_prices_to_cents()
+    click.echo('Database initialized.')
+
+# Convert old FLOAT prices before serving anything, so no request sees unmigrated data
+with app.app_context():
+    migrate_prices_to_cents()
+
 # Main block
 if __name__ == '__main__':
-    with app.app_context():
-        db.create_all()  # This will create the database tables
+    app.config['STRICT_LOADING'] = True  # Running with debug=True below
     app.run(debug=True, port=5001)
-